@@ -1,5 +1,9 @@
 import argparse
+import atexit
+import contextlib
 import inspect
+import os
+import struct
 import time
 import usb
 
@@ -10,45 +14,128 @@ import usb
 vendor_id = 0x1e71
 product_id = 0x1714
 
+# seconds to wait between the two packets of a write (dev.write already blocks until the
+# transfer completes, so no delay is needed by default)
+INTER_PACKET_DELAY = float(os.environ.get('PYCAM_INTER_PACKET_DELAY', 0))
+
+
+# cached device handle and claim state (shared by all calls in this process)
+_dev = None
+_claimed = False
+
 
 def get_device():
-    """ return device handle """
-    dev = usb.core.find(idVendor=vendor_id, idProduct=product_id)
-    if dev is None:
-        raise ValueError('device not found')
-    return dev
+    """ return (cached) device handle """
+    global _dev
+    if _dev is None:
+        _dev = usb.core.find(idVendor=vendor_id, idProduct=product_id)
+        if _dev is None:
+            raise ValueError('device not found')
+    return _dev
+
+
+def get_out_endpoint(dev):
+    """ return the endpoint packets are written to (looked up once per device) """
+    endpoint = getattr(dev, '_ep_out', None)
+    if endpoint is not None:
+        return endpoint
+
+    def is_out(endpoint):
+        """ check if data flows from host to device """
+        return usb.util.endpoint_direction(endpoint.bEndpointAddress) == usb.util.ENDPOINT_OUT
+
+    interface = dev.get_active_configuration()[(0, 0)]
+    endpoint = usb.util.find_descriptor(interface, custom_match=is_out)
+    if endpoint is None:
+        raise ValueError('output endpoint not found')
+    dev._ep_out = endpoint
+    return endpoint
 
 
 def claim(dev):
-    """ assert control over device """
+    """ assert control over device (no-op if already claimed) """
+    global _claimed
+    if _claimed:
+        return
     if dev.is_kernel_driver_active(0):
         dev.detach_kernel_driver(0)
+    _claimed = True
 
 
 def declaim(dev):
     """ return control over device to kernel """
-    usb.util.dispose_resources(dev)
+    global _claimed
+    _release(dev)
     if not dev.is_kernel_driver_active(0):
         dev.attach_kernel_driver(0)
+    _claimed = False
 
 
-def write(packet1, packet2):
-    """ send packet to dev """
-    assert len(packet1) == 65
-    assert len(packet2) == 65
+def _release(dev):
+    """ free usb resources but keep the device claimed for later writes """
+    usb.util.dispose_resources(dev)
+
 
+@atexit.register
+def _final_release():
+    """ give the device back to the kernel driver on interpreter exit """
+    if _dev is not None and _claimed:
+        declaim(_dev)
+
+
+@contextlib.contextmanager
+def device():
+    """ claim device for a with block (the kernel driver is reattached on exit only) """
     dev = get_device()
     claim(dev)
-    dev.write(1, packet1)
-    time.sleep(0.05)
-    dev.write(1, packet2)
-    declaim(dev)
+    try:
+        yield dev
+    finally:
+        _release(dev)
+
+
+def _write_raw(dev, packet1, packet2):
+    """ send packets to an already claimed dev """
+    assert len(packet1) == 65
+    assert len(packet2) == 65
+
+    endpoint = get_out_endpoint(dev)
+    endpoint.write(packet1)
+    if INTER_PACKET_DELAY:
+        time.sleep(INTER_PACKET_DELAY)
+    endpoint.write(packet2)
+
+
+def write(packet1, packet2, dev=None):
+    """ send packet to dev (claims the device if no dev is given) """
+    write_batch([(packet1, packet2)], dev=dev)
+
+
+def write_batch(packets, dev=None):
+    """ send (packet1, packet2) pairs one after another (claims the device once) """
+    if not packets:
+        return
+
+    if dev is not None:
+        for packet1, packet2 in packets:
+            _write_raw(dev, packet1, packet2)
+        return
+
+    with device() as dev:
+        write_batch(packets, dev=dev)
 
 
 # settings
 
 LED_COUNT = 20
 
+# packs grb bytes of all leds at once
+_COLOR_PACKER = struct.Struct('BBB' * LED_COUNT)
+
+# static packets for turning off all leds
+_OFF_PACKET1 = bytes([2, 75]) + bytes(63)
+_OFF_PACKET2 = bytes([3]) + bytes(64)
+
 
 # modes
 
@@ -102,50 +189,108 @@ class Direction:
 # base functions
 
 def set_led_preset(mode, index=0, r=0, g=0, b=255, speed=0, direction=0, option_byte=0,
-                   led_group_size=0):
+                   led_group_size=0, dev=None):
     """ repeat given color for each led """
-    colors = [(r, g, b)] * LED_COUNT
-    set_led(mode, colors, index, speed, direction, option_byte, led_group_size)
+    packets = build_preset_packets(mode, index, r, g, b, speed, direction, option_byte,
+                                   led_group_size)
+    write(*packets, dev=dev)
 
 
-def set_led(mode, colors, index=0, speed=0, direction=0, option_byte=0, led_group_size=0):
+def set_led(mode, colors, index=0, speed=0, direction=0, option_byte=0, led_group_size=0,
+            dev=None):
     """ low level led interface """
+    packets = build_packets(mode, colors, index, speed, direction, option_byte, led_group_size)
+    write(*packets, dev=dev)
+
+
+def build_preset_packets(mode, index=0, r=0, g=0, b=255, speed=0, direction=0, option_byte=0,
+                         led_group_size=0):
+    """ return packets for set_led_preset without sending them """
+    packets = _build_preset_steps(mode, [(r, g, b)], index, speed, direction, option_byte,
+                                  led_group_size)
+    return packets[0]
+
+
+def build_packets(mode, colors, index=0, speed=0, direction=0, option_byte=0, led_group_size=0):
+    """ return packets for set_led without sending them """
     if len(colors) > 20:
         raise ValueError(f'too many colors (there are only {LED_COUNT} leds)')
 
-    # resort colors to grb and flatten them to a 1d list
-    colors = [(g, r, b) for r, g, b in colors]
-    colors_flat = [item for rgb in colors for item in rgb]
+    packet1, packet2 = _empty_packets(mode, index, speed, direction, option_byte,
+                                      led_group_size)
+
+    # resort colors to grb and pad them with zeroes for the leds left
+    flat = [value for r, g, b in colors for value in (g, r, b)]
+    flat += [0] * (3 * LED_COUNT - len(flat))
+    try:
+        packed = _COLOR_PACKER.pack(*flat)
+    except struct.error as error:
+        raise ValueError(f'invalid color value ({error})') from error
+
+    # last 3 bytes of packet1 can't be used for colors
+    packet1[5:62] = packed[:57]
+    packet2[1:4] = packed[57:]
+
+    return packet1, packet2
+
 
-    # build packets
-    packet1 = [
-        2,
-        75,
-        mode,
-        (direction << 4) | (option_byte << 3),
-        (index << 5) | (led_group_size << 3) | speed,
-    ] + colors_flat[:57]  # last 3 bytes can't be used for colors
+def _empty_packets(mode, index, speed, direction, option_byte, led_group_size):
+    """ return packets with header bytes set and all colors zeroed """
+    packet1 = bytearray(65)
+    packet1[0] = 2
+    packet1[1] = 75
+    packet1[2] = mode
+    packet1[3] = (direction << 4) | (option_byte << 3)
+    packet1[4] = (index << 5) | (led_group_size << 3) | speed
 
-    packet2 = [3] + colors_flat[57:]
+    packet2 = bytearray(65)
+    packet2[0] = 3
 
-    def fill(data):
-        """ fill list with zeroes to length 65 """
-        if len(data) < 65:
-            data += [0] * (65 - len(data))
+    return packet1, packet2
 
-    fill(packet1)
-    fill(packet2)
 
-    write(bytes(packet1), bytes(packet2))
+def _build_preset_steps(mode, colors, index=0, speed=0, direction=0, option_byte=0,
+                        led_group_size=0):
+    """ return packets for one preset color per animation step (starting at index) """
+    # header bytes only differ in the index, so build them once
+    header1, header2 = _empty_packets(mode, 0, speed, direction, option_byte, led_group_size)
+
+    packets = list()
+    for step, (r, g, b) in enumerate(colors, index):
+        packet1 = bytearray(header1)
+        packet2 = bytearray(header2)
+        packet1[4] |= step << 5
+
+        # repeat the grb pattern for each led, last 3 bytes of packet1 can't be used for colors
+        packed = bytes((g, r, b)) * LED_COUNT
+        packet1[5:62] = packed[:57]
+        packet2[1:4] = packed[57:]
+
+        packets.append((packet1, packet2))
+
+    return packets
+
+
+def _set_led_batch(mode, colors, speed=0, direction=0, option_byte=0, led_group_size=0,
+                   dev=None):
+    """ set one preset color per animation step and send all steps at once """
+    packets = _build_preset_steps(mode, colors, 0, speed, direction, option_byte,
+                                  led_group_size)
+    write_batch(packets, dev=dev)
 
 
 # modes
 
 modes = list()
 
+# cli flags shown in the mode help
+ALL_FLAGS = ('speed', 'direction', 'size', 'moving')
+
 
 def mode(func):
-    """ mode decorator for generating help """
+    """ mode decorator for generating help (stores the supported cli flags on func) """
+    func.flags = tuple(param for param in inspect.signature(func).parameters
+                       if param in ALL_FLAGS)
     modes.append(func)
     return func
 
@@ -153,10 +298,7 @@ def mode(func):
 @mode
 def off():
     """ turn off all leds """
-    array = [2, 75] + [0] * 63
-    array2 = [3] + [0] * 64
-
-    write(bytes(array), bytes(array2))
+    write(_OFF_PACKET1, _OFF_PACKET2)
 
 
 @mode
@@ -169,15 +311,13 @@ def fixed(color):
 @mode
 def breathing(*colors, speed=Speed.NORMAL):
     """ fade brightness in, out and then change color """
-    for i, (r, g, b) in enumerate(colors):
-        set_led_preset(mode=PresetMode.BREATHING, index=i, r=r, g=g, b=b, speed=speed)
+    _set_led_batch(PresetMode.BREATHING, colors, speed=speed)
 
 
 @mode
 def fading(*colors, speed=Speed.NORMAL):
     """ fade between given colors """
-    for i, (r, g, b) in enumerate(colors):
-        set_led_preset(mode=PresetMode.FADING, index=i, r=r, g=g, b=b, speed=speed)
+    _set_led_batch(PresetMode.FADING, colors, speed=speed)
 
 
 @mode
@@ -196,18 +336,13 @@ def marquee(color, speed=Speed.NORMAL, direction=Direction.FORWARD, size=3):
 @mode
 def covering_marquee(*colors, speed=Speed.NORMAL, direction=Direction.FORWARD):
     """ marquee consisting of multiple colors """
-    for i, (r, g, b) in enumerate(colors):
-        set_led_preset(
-            mode=PresetMode.COVERING_MARQUEE, index=i, r=r, g=g, b=b, speed=speed,
-            direction=direction,
-        )
+    _set_led_batch(PresetMode.COVERING_MARQUEE, colors, speed=speed, direction=direction)
 
 
 @mode
 def pulse(*colors, speed=Speed.NORMAL):
     """ fade color out and then show next color with full brightness """
-    for i, (r, g, b) in enumerate(colors):
-        set_led_preset(mode=PresetMode.PULSE, index=i, r=r, g=g, b=b, speed=speed)
+    _set_led_batch(PresetMode.PULSE, colors, speed=speed)
 
 
 @mode
@@ -223,15 +358,9 @@ def alternating(color1, color2, speed=Speed.NORMAL, direction=Direction.FORWARD,
     if size < 3 or size > 6:
         raise ValueError('size has to be between 3 and 6')
 
-    r1, g1, b1 = color1
-    set_led_preset(
-        mode=PresetMode.ALTERNATING, index=0, r=r1, g=g1, b=b1, speed=speed, direction=direction,
-        led_group_size=size - 3, option_byte=int(moving),
-    )
-    r2, g2, b2 = color2
-    set_led_preset(
-        mode=PresetMode.ALTERNATING, index=1, r=r2, g=g2, b=b2, speed=speed, direction=direction,
-        led_group_size=size - 3, option_byte=int(moving),
+    _set_led_batch(
+        PresetMode.ALTERNATING, (color1, color2), speed=speed, direction=direction,
+        option_byte=int(moving), led_group_size=size - 3,
     )
 
 
@@ -288,18 +417,13 @@ if __name__ == '__main__':
         return map(int, arg.split(','))
 
     # generate mode help
-    all_flags = ('speed', 'direction', 'size', 'moving')
     mode_table = list()
     for mode in modes:
-        signature = inspect.signature(mode)
-        flags = filter(lambda param: param in all_flags, signature.parameters)
-        flags_string = ', '.join(flags)
+        flags_string = ', '.join(mode.flags)
         mode_table.append([f'  {mode.__name__}', f'{mode.__doc__[1:-1]} ({flags_string})'])
 
     # format mode help table
-    max_length = 23
-    for entry in mode_table:
-        max_length = max(max_length, len(entry[0]))
+    max_length = max(23, max((len(entry[0]) for entry in mode_table), default=0))
     header = 'modes (allowed flags):'
     mode_help = [header] + [entry[0].ljust(max_length) + entry[1] for entry in mode_table]
 